@@ -1,64 +1,139 @@
 ## Module and CLI for citation file conversion
 
 import argparse
-import os, sys
+import io
+import json
+import os, re, sys
+from collections import ChainMap
 from datetime import datetime
 import bibtexparser
 
+## Built once per process; the middleware holds no per-parse state
+_LATEX_LAYERS = (bibtexparser.middlewares.LatexDecodingMiddleware(),)
+
+## Default parse stack without string resolution, which process() does itself
+_BLOCK_LAYERS = (bibtexparser.middlewares.RemoveEnclosingMiddleware(),) + _LATEX_LAYERS
+
+## BibTeX fields copied into Citation.info_dict
+_BIB_FIELDS = ('title', 'booktitle', 'pages', 'year', 'month', 'day', 'journal',
+               'volume', 'series', 'issue', 'editor', 'publisher', 'url', 'doi', 'abstract')
+
+## https://docs.github.com/en/repositories/managing-your-repositorys-settings-and-features/customizing-your-repository/about-citation-files
+_TYPE_MAP = {'article': 'article', 'book': 'book', 'booklet': 'pamphlet',
+             'inproceedings': 'conference-paper', 'proceedings': 'proceedings',
+             'misc': 'generic', 'manual': 'manual', 'software': 'software',
+             'techreport': 'report', 'unpublished': 'unpublished'}
+
+## BibTeX month names and abbreviations
+_MONTH_NAMES = ('january', 'february', 'march', 'april', 'may', 'june', 'july',
+                'august', 'september', 'october', 'november', 'december')
+_MONTHS = {**{name: i for i, name in enumerate(_MONTH_NAMES, 1)},
+           **{name[:3]: i for i, name in enumerate(_MONTH_NAMES, 1)},
+           'sept': 9}
+
+## Top-level CFF keys, each written from the first of its source keys present
+## (info_dict keys, plus 'cff_version' for the export_as_cff() argument)
+_TOP_KEYS = (('date-released', ('date-released',)),
+             ('doi', ('doi', 'repo_doi')),  # prioritise paper doi over repo doi
+             ('title', ('title',)),
+             ('cff-version', ('cff_version',)),
+             ('version', ('repo_version',)))
+
+## preferred-citation keys written as a nested name
+_PREF_NAME_KEYS = ('publisher', 'conference')
+
+## preferred-citation keys written as plain values
+_PREF_KEYS = ('doi', 'url', 'date-released', 'issue', 'volume', 'journal', 'title',
+              'booktitle', 'editor', 'series', 'publisher', 'start', 'end')
+
+## Braces not escaped with a backslash, as counted by bibtexparser's splitter
+_BRACE_RE = re.compile(r'(?<!\\)[{}]')
+
+def _date_number(key, value, maximum):
+    '''Return the month or day value of a bibtex date field as an int'''
+    text = str(value).strip().lower().rstrip('.')
+    if text.isdigit():
+        number = int(text)
+    elif key == 'month':
+        number = _MONTHS.get(text)
+    else:
+        number = None
+    if number is None or not 1 <= number <= maximum:
+        raise ValueError(f'Cannot read {key} field {value!r} in bibtex entry')
+    return number
+
+def _q(value):
+    '''Return value as a double-quoted YAML scalar, escaping as needed'''
+    return json.dumps(str(value), ensure_ascii=False)
+
 class Citation():
-    def __init__(self, bibtex_string):
+    def __init__(self, bibtex_string=None):
         self.info_dict = {}
         self.bibtex_provided = False
         self.repo_provided = False
 
-        self.parse_bibtex(bibtex_string)
+        if bibtex_string is not None:
+            self.parse_bibtex(bibtex_string)
 
+    @classmethod
+    def from_entry(cls, bib_info):
+        '''Create a citation from an already parsed bibtexparser entry'''
+        citation = cls()
+        citation.parse_entry(bib_info)
+        return citation
 
     def parse_bibtex(self, bibtex_string):
         '''Load bibtex file from string, and save data in self.info_dict'''
-        layers = [bibtexparser.middlewares.LatexDecodingMiddleware()]
-        library = bibtexparser.parse_string(bibtex_string, append_middleware=layers)
+        library = bibtexparser.parse_string(bibtex_string, append_middleware=_LATEX_LAYERS)
+
+        if len(library.entries) != 1:
+            raise ValueError(f'Expected 1 entry in bibtex string, found {len(library.entries)}')
+        self.parse_entry(library.entries[0])
 
-        assert len(library.entries) == 1, 'more than 1 entries in bib tex file, give ind or something'
-        bib_info = library.entries[0]
-        assert type(bib_info) == bibtexparser.model.Entry
+    def parse_entry(self, bib_info):
+        '''Save data of a parsed bibtexparser entry in self.info_dict'''
+        assert isinstance(bib_info, bibtexparser.model.Entry)
 
-        bib_keys = bib_info.fields_dict.keys()
+        bib_keys = bib_info.fields_dict
         self.info_dict['ENTRYTYPE'] = bib_info.entry_type
-        for key in ['title', 'booktitle', 'pages', 'year', 'month', 'day', 'journal',
-                    'volume', 'series', 'issue', 'editor', 'publisher', 'url', 'doi', 'abstract']:
+        for key in _BIB_FIELDS:
             if key in bib_keys:
                 self.info_dict[key] = bib_info[key]
 
-        if 'pages' in self.info_dict.keys():
-            ## Expected format: 'start--stop'
-            split_pages = self.info_dict['pages'].split('–')
-            if len(split_pages) == 2:
-                self.info_dict['start'] = int(split_pages[0])
-                self.info_dict['end'] = int(split_pages[1])
-            elif len(split_pages) == 1:
-                self.info_dict['start'] = split_pages[0]
-            else:
-                assert False, 'pages does not have expected format'
+        if 'pages' in self.info_dict:
+            ## Expected format: 'start--stop' (LaTeX decoding may turn '--' into '–')
+            pages = self.info_dict['pages']
+            for sep in ('--', '–', '-'):
+                start, found, end = pages.partition(sep)
+                if found:
+                    start, end = start.strip(), end.strip()
+                    if start.isdigit() and end.isdigit():
+                        self.info_dict['start'] = int(start)
+                        self.info_dict['end'] = int(end)
+                        break
+            else:  # single page or article number such as 'e0123-19'
+                self.info_dict['start'] = pages
 
         ## Author info
         if 'author' in bib_keys:
-            author_list = bib_info['author'].split(' and ')
-            self.info_dict['n_authors'] = len(author_list)
-            author_dict = {}
-            for ind, author_name in enumerate(author_list):
-                author_dict[ind] = {}
-                if ',' in author_name:
-                    assert len(author_name.split(',')) == 2, f'More than 1 comma (,) in {author_name}'
-                    author_dict[ind]['full_name'] = author_name.strip()
-                    author_dict[ind]['first_name'] = author_name.split(',')[1].strip()
-                    author_dict[ind]['last_name'] = author_name.split(',')[0].strip()
+            author_names = bib_info['author'].split(' and ')
+            self.info_dict['n_authors'] = len(author_names)
+            author_list = []
+            for author_name in author_names:
+                head, sep, tail = author_name.partition(',')
+                if sep:
+                    if ',' in tail:
+                        raise ValueError(f'More than 1 comma (,) in {author_name}')
+                    first_name, last_name = tail.strip(), head.strip()
                 else:
-                    assert len(author_name.split()) == 2, f'More than two names {author_name}'
-                    author_dict[ind]['full_name'] = author_name.strip()
-                    author_dict[ind]['first_name'] = author_name.split()[0].strip()
-                    author_dict[ind]['last_name'] = author_name.split()[1].strip()
-            self.info_dict['author_dict'] = author_dict
+                    names = author_name.split(None, 2)
+                    if len(names) != 2:
+                        raise ValueError(f'Expected two names in {author_name}')
+                    first_name, last_name = names
+                author_list.append({'full_name': author_name.strip(),
+                                    'first_name': first_name,
+                                    'last_name': last_name})
+            self.info_dict['authors'] = author_list
         else:
             self.info_dict['author'] = None
 
@@ -67,142 +142,201 @@ class Citation():
     def prep_info_for_export(self):
         '''Run some checks and make data in order'''
         assert self.bibtex_provided, 'bibtex file not yet provided'
-
-        idk = self.info_dict.keys()
+        d = self.info_dict
+        if 'title' not in d:
+            raise ValueError('No title in bibtex entry')
 
         ## Prep date:
-        find_date = True
-        construct_date = False
-        while find_date:
-            if 'date-released' in idk:
-                find_date = False
-            elif 'date' in idk:
-                self.info_dict['date-released'] = self.info_dict['date']
-                find_date = False
-
-            construct_date = True
-            dt = datetime.now()
-            if 'year' in idk:
-                year = self.info_dict['year']
-            else:  # use current date
-                year = dt.year
-                month = dt.month
-                day = dt.day
-                find_date = False
-            if 'month' in idk:
-                month = self.info_dict['month']
-            else:  # if year known but not month, just to 1 Jan
-                month = 1
-                day = 1
-                find_date = False
-            if 'day' in idk:
-                day = self.info_dict['day']
-                find_date = False
-            else:
-                day = 1
-                find_date = False
-
-
-        if construct_date:
-            self.info_dict['date-released'] = f'{year}-{str(month).zfill(2)}-{str(day).zfill(2)}'
+        if 'date-released' in d:
+            pass
+        elif 'date' in d:
+            d['date-released'] = d['date']
+        else:  # construct from year/month/day, defaulting to current year and 1 Jan
+            year = str(d['year'] if 'year' in d else datetime.now().year).strip()
+            if not year.isdigit():
+                raise ValueError(f'Cannot read year field {year!r} in bibtex entry')
+            month = _date_number('month', d.get('month', 1), 12)
+            day = _date_number('day', d.get('day', 1), 31)
+            d['date-released'] = f'{int(year):04d}-{month:02d}-{day:02d}'
 
         ## Bibtex type:
-        if 'ENTRYTYPE' in self.info_dict.keys():
-            type_mapping_bib_to_cff = {'article': 'article', 'book': 'book', 'booklet': 'pamphlet',
-                                       'inproceedings': 'conference-paper', 'proceedings': 'proceedings',
-                                       'misc': 'generic', 'manual': 'manual', 'software': 'software',
-                                       'techreport': 'report', 'unpublished': 'unpublished'}  #https://docs.github.com/en/repositories/managing-your-repositorys-settings-and-features/customizing-your-repository/about-citation-files
-            self.info_dict['cff_type'] = type_mapping_bib_to_cff[self.info_dict['ENTRYTYPE']]
+        if 'ENTRYTYPE' in d:
+            d['cff_type'] = _TYPE_MAP[d['ENTRYTYPE']]
 
         ## Journal
-        if 'journal' not in self.info_dict.keys():
-            if 'series' in self.info_dict.keys():
-                self.info_dict['journal'] = self.info_dict['series']
+        if 'journal' not in d:
+            if 'series' in d:
+                d['journal'] = d['series']
 
         ## To copy booktitle (ignored by github) as conference.name
-        if 'cff_type' in self.info_dict.keys() and self.info_dict['cff_type'] == 'conference-paper':
-            if 'booktitle' in self.info_dict.keys():
-                if 'conference' not in self.info_dict.keys():
-                    self.info_dict['conference'] = self.info_dict['booktitle']
-
-    def add_author_names_to_cff(self, indent_n_spaces=0):
-        '''Add list of all author names to cff file'''
-        assert type(indent_n_spaces) == int and indent_n_spaces >= 0
-        id = ' ' * indent_n_spaces
-        assert 'author_dict' in self.info_dict
-        ad = self.info_dict['author_dict']
-        assert self.info_dict['n_authors'] == len(ad)
-        assert len(ad) > 0
-
-        f = sys.stdout
-        f.write(f'{id}authors:\n')
-        for i_author, author_name_dict in ad.items():
-            # f.write(f'{id}  - name-suffix: "N/A"\n')
-            f.write(f'{id}  - family-names: "{author_name_dict["last_name"]}"\n')
-            f.write(f'{id}    given-names: "{author_name_dict["first_name"]}"\n')
-            # f.write(f'{id}    name-particle: "N/A"\n')
-            if 'orcid' in author_name_dict.keys():
-                f.write(f'{id}    orcid: "{author_name_dict["orcid"]}"\n')
-
-    def export_as_cff(self, cff_version="1.2.0"):
-        '''Export citation info to a cff file.'''
-        assert type(cff_version) == str, type(cff_version)
-        self.prep_info_for_export()
+        if 'cff_type' in d and d['cff_type'] == 'conference-paper':
+            if 'booktitle' in d:
+                if 'conference' not in d:
+                    d['conference'] = d['booktitle']
+
+    def author_lines(self):
+        '''Return the unindented cff lines of all author names'''
+        d = self.info_dict
+        if not d.get('authors'):
+            raise ValueError('No authors in bibtex entry')
+        ad = d['authors']
+        assert d['n_authors'] == len(ad)
 
-        f = sys.stdout
-        f.write(f'date-released: "{self.info_dict["date-released"]}"\n')
-        ## Prioritise paper doi over repo doi:
-        if 'doi' in self.info_dict.keys():
-            f.write(f'doi: "{self.info_dict["doi"]}"\n')
-        elif 'repo_doi' in self.info_dict.keys():
-            f.write(f'doi: "{self.info_dict["repo_doi"]}"\n')
-        f.write(f'title: "{self.info_dict["title"]}"\n')
-        f.write(f'cff-version: "{cff_version}"\n')
-        if 'repo_version' in self.info_dict.keys():
-            f.write(f'version: "{self.info_dict["repo_version"]}"\n')
-
-        self.add_author_names_to_cff(indent_n_spaces=0)
-
-        f.write('preferred-citation:\n')
-        if 'cff_type' in self.info_dict.keys():
-            f.write(f'  type: "{self.info_dict["cff_type"]}"\n')
+        lines = ['authors:\n']
+        for author_name_dict in ad:
+            # lines.append('  - name-suffix: "N/A"\n')
+            lines.append(f'  - family-names: {_q(author_name_dict["last_name"])}\n')
+            lines.append(f'    given-names: {_q(author_name_dict["first_name"])}\n')
+            # lines.append('    name-particle: "N/A"\n')
+            if 'orcid' in author_name_dict:
+                lines.append(f'    orcid: {_q(author_name_dict["orcid"])}\n')
+        return lines
+
+    def add_author_names_to_cff(self, parts, indent_n_spaces=0, author_lines=None):
+        '''Append list of all author names to the cff output parts'''
+        assert isinstance(indent_n_spaces, int) and indent_n_spaces >= 0
+        if author_lines is None:
+            author_lines = self.author_lines()
+        if indent_n_spaces == 0:
+            parts.extend(author_lines)
         else:
-            f.write('  type: "generic"\n')
-        if 'publisher' in self.info_dict:
-            f.write('  publisher:\n')
-            f.write(f'    name: "{self.info_dict["publisher"]}"\n')
-        if 'conference' in self.info_dict:
-            f.write('  conference:\n')
-            f.write(f'    name: "{self.info_dict["conference"]}"\n')
-        for key in ['doi', 'url', 'date-released', 'issue', 'volume', 'journal', 'title',
-                    'booktitle', 'editor', 'series', 'publisher', 'start', 'end']:
-            if key in self.info_dict.keys():
-                f.write(f'  {key}: "{self.info_dict[key]}"\n')
-
-        self.add_author_names_to_cff(indent_n_spaces=2)
+            id = ' ' * indent_n_spaces
+            parts.extend(id + line for line in author_lines)
+
+    def export_as_cff(self, cff_version="1.2.0", file=None):
+        '''Export citation info to a cff file (stdout by default).'''
+        self.prep_info_for_export()
+        d = self.info_dict
+
+        parts = []
+        top = ChainMap({'cff_version': cff_version}, d)
+        for cff_key, source_keys in _TOP_KEYS:
+            for source_key in source_keys:
+                if source_key in top:
+                    parts.append(f'{cff_key}: {_q(top[source_key])}\n')
+                    break
+
+        ## Format the author names once for both author lists
+        author_lines = self.author_lines()
+        self.add_author_names_to_cff(parts, indent_n_spaces=0, author_lines=author_lines)
+
+        parts.append('preferred-citation:\n')
+        parts.append(f'  type: {_q(d.get("cff_type", "generic"))}\n')
+        for key in _PREF_NAME_KEYS:
+            if key in d:
+                parts.append(f'  {key}:\n    name: {_q(d[key])}\n')
+        for key in _PREF_KEYS:
+            if key in d:
+                parts.append(f'  {key}: {_q(d[key])}\n')
+
+        self.add_author_names_to_cff(parts, indent_n_spaces=2, author_lines=author_lines)
+        (file or sys.stdout).write(''.join(parts))
+
+def _iter_entries(file_input):
+    """Yield the text of each top-level @block{...} of the input in turn"""
+    lines = []
+    depth = 0
+    opened = False
+    for line in file_input:
+        if not lines and not line.startswith('@'):
+            continue  # text between blocks is an implicit comment
+        lines.append(line)
+        for brace in _BRACE_RE.findall(line):
+            depth += 1 if brace == '{' else -1
+            opened = True
+        if opened and depth <= 0:
+            yield ''.join(lines)
+            lines = []
+            depth = 0
+            opened = False
+    if lines:
+        yield ''.join(lines)
+
+
+def _resolve_macros(library, macros):
+    """Replace @string macro references in the entries of library"""
+    for entry in library.entries:
+        for field in entry.fields:
+            ## Enclosed values start with '{' or '"', so never match a macro name
+            if isinstance(field.value, str) and field.value in macros:
+                field.value = macros[field.value]
+
 
 def process(args, file_name, file_input):
-    """Process the specified input"""
-    bibtex_data = file_input.read()
-    citation = Citation(bibtex_data)
-    citation.export_as_cff()
+    """Yield a Citation for each entry of the specified input"""
+    ## Raw @string values seen so far, resolved into later entries by hand so
+    ## that each block is parsed only once
+    macros = {}
+    n_entries = 0
+    for block in _iter_entries(file_input):
+        library = bibtexparser.parse_string(block, parse_stack=[])
+        if library.failed_blocks:
+            first_line = block.splitlines()[0]
+            raise ValueError(f'{file_name}: cannot parse bibtex block {first_line!r}')
+        for string in library.strings:
+            macros[string.key] = string.value
+        _resolve_macros(library, macros)
+        for middleware in _BLOCK_LAYERS:
+            library = middleware.transform(library=library)
+        for entry in library.entries:
+            n_entries += 1
+            yield Citation.from_entry(entry)
+    if n_entries == 0:
+        raise ValueError(f'{file_name}: no bibtex entries found')
+
+
+def _batch_file_names(file_input):
+    """Return the NUL- or newline-separated file names of the input"""
+    names = file_input.read()
+    separator = '\0' if '\0' in names else '\n'
+    return [name for name in names.split(separator) if name]
+
+
+def _citations(args, file_names):
+    """Yield the citations of all specified files"""
+    for file_name in file_names:
+        if file_name == '-':
+            yield from process(args, '<stdin>', sys.stdin)
+        else:
+            with open(file_name) as file_input:
+                yield from process(args, file_name, file_input)
 
 
 def main():
     """Program entry point"""
     parser = argparse.ArgumentParser(
         description='BibTeX to CFF converter')
+    parser.add_argument('-b', '--batch',
+                        help='Read the names of the files to process from stdin',
+                        action='store_true')
+    parser.add_argument('-o', '--output',
+                        help='File to write the CFF output to',
+                        type=str)
     parser.add_argument('file',
                         help='File to process',
-                        nargs='*', default='-',
+                        nargs='*', default=['-'],
                         type=str)
     args = parser.parse_args()
-    for file_name in args.file:
-        if file_name == '-':
-            process(args, '<stdin>', sys.stdin)
-        else:
-            with open(file_name) as file_input:
-                process(args, file_name, file_input)
+    if args.batch:
+        if args.file != ['-']:
+            parser.error('file arguments cannot be combined with --batch')
+        file_names = _batch_file_names(sys.stdin)
+    else:
+        file_names = args.file
+
+    ## Buffer output for a file, so that a failed conversion leaves it untouched
+    out = io.StringIO() if args.output else sys.stdout
+    try:
+        for i, citation in enumerate(_citations(args, file_names)):
+            ## Separate multiple citations as YAML documents
+            if i > 0:
+                out.write('---\n')
+            citation.export_as_cff(file=out)
+        if args.output:
+            with open(args.output, 'w') as file_output:
+                file_output.write(out.getvalue())
+    except (OSError, ValueError) as e:
+        sys.exit(f'{parser.prog}: error: {e}')
 
 if __name__ == "__main__":
     main()